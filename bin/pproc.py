@@ -19,10 +19,14 @@ See: https://stackoverflow.com/questions/9743838/python-subprocess-in-parallel
 ## Imports
 ##########################################################################
 
+import os
+import sys
+import fcntl
 import shlex
 import argparse
+import functools
+import selectors
 
-from select import select
 from subprocess import Popen, PIPE
 
 ##########################################################################
@@ -33,23 +37,104 @@ DESCRIPTION = "Run multiple subprocesses concurrently, serializing stdout"
 EPILOG      = "This is a Bengfort toolkit command"
 VERSION     = "%(prog)s v1.0"
 
+# Capacity requested for each child's stdout pipe: a larger pipe lets chatty
+# children keep writing between wakeups so that each read moves more data.
+# Pipe buffers count against the per-user fs.pipe-user-pages-soft limit (64
+# MiB by default), so the total across all children is capped by the budget
+# and pipes are left at the default size when the share is no larger.
+PIPE_SIZE   = 1 << 18
+PIPE_BUDGET = 1 << 24
+PIPE_DEFAULT_SIZE = 1 << 16
+
+# Interval to poll processes for exit when no pidfd is available
+POLL_INTERVAL = 0.1
+
+# Maximum number of bytes read from a child at each readiness event, enough
+# to drain a full pipe in a single read
+READ_SIZE   = PIPE_SIZE
+
+# Popen keyword arguments and defaults; stdout is kept as bytes so that
+# child output is passed through without a decode and re-encode.
+POPEN_KWDS  = {
+    "stdout": PIPE,
+    "close_fds": True,
+}
+
 
 ##########################################################################
 ## Command Functions
 ##########################################################################
 
+@functools.lru_cache(maxsize=128)
+def split(command):
+    """
+    Tokenizes a single command with shlex, caching the result since the same
+    command is often fanned out many times in a single invocation.
+    """
+    return tuple(shlex.split(command))
+
+
 def tokenize(commands):
     for command in commands:
-        yield shlex.split(command)
+        yield list(split(command))
+
+
+def pprint(out, prefix, data):
+    """
+    Writes process output to the binary stream out, marking each line with
+    the prefix (precomputed per process) if one is given.
+    """
+    if not prefix:
+        out.write(data)
+        return
 
+    # Lines are only split on newlines (a carriage return, e.g. from a
+    # progress bar, is not a new line) and an unterminated final line is
+    # ended so that the next label starts on a line of its own.
+    lines = data.split(b"\n")
+    last  = lines.pop()
+    for line in lines:
+        out.write(prefix + line + b"\n")
 
-def pprint(proc):
-    # pretty print the standard out of the process
-    msg = "[{}] out: {}".format(p.pid, p.stdout.read())
-    print(msg, end="")
+    if last:
+        out.write(prefix + last + b"\n")
 
 
-def execute(commands, debug=False, timeout=0.1):
+def pipe_share(nprocs):
+    """
+    Returns the pipe size for each of nprocs children within the budget,
+    rounded down to a power of two since the kernel rounds sizes up.
+    """
+    share = min(PIPE_SIZE, PIPE_BUDGET // max(nprocs, 1))
+    return 1 << (share.bit_length() - 1)
+
+
+def resize_pipe(fobj, size=PIPE_SIZE):
+    """
+    Grows the kernel buffer of the pipe where supported (Linux). Failures are
+    ignored since unprivileged users are capped by fs.pipe-max-size.
+    """
+    if not hasattr(fcntl, "F_SETPIPE_SZ") or size <= PIPE_DEFAULT_SIZE:
+        return
+
+    try:
+        fcntl.fcntl(fobj, fcntl.F_SETPIPE_SZ, size)
+    except OSError:
+        pass
+
+
+def open_pidfd(proc):
+    """
+    Returns a file descriptor that becomes readable when the process exits,
+    or None if pidfds are not supported (non-Linux or kernels before 5.3).
+    """
+    try:
+        return os.pidfd_open(proc.pid)
+    except (AttributeError, OSError):
+        return None
+
+
+def execute(commands, debug=False, timeout=None, prefix=False):
     # Use shlex to tokenize commands
     commands = list(tokenize(commands))
 
@@ -59,30 +144,94 @@ def execute(commands, debug=False, timeout=0.1):
             print(repr(command))
         return
 
-    # Popen keyword arguments and defaults
-    kwds = {
-        "stdout": PIPE,
-        "bufsize": 1,
-        "close_fds": True,
-        "universal_newlines": True,
-    }
+    out = sys.stdout.buffer
+
+    # Build the process list and register each stdout for read readiness
+    # (epoll on Linux) so each wakeup only touches the ready processes. Where
+    # supported, a pidfd is registered as well so that process exit is an
+    # event rather than a state that has to be polled. Per-process state is
+    # keyed by pid so that reaping a process is a constant time delete.
+    sel    = selectors.DefaultSelector()
+    procs  = {}
+    pidfds = {}
+    labels = {}
+    tails  = {}
+    closed = {}
+    psize  = pipe_share(len(commands))
+    for cmd in commands:
+        p = Popen(cmd, **POPEN_KWDS)
+        resize_pipe(p.stdout, psize)
+        sel.register(p.stdout, selectors.EVENT_READ, data=("out", p))
+
+        pidfd = open_pidfd(p)
+        if pidfd is not None:
+            sel.register(pidfd, selectors.EVENT_READ, data=("exit", p))
+            pidfds[p.pid] = pidfd
 
-    # Build the process list
-    procs = [Popen(cmd, **kwds) for cmd in commands]
+        procs[p.pid]  = p
+        labels[p.pid] = f"[{p.pid}] out: ".encode() if prefix else b""
+        tails[p.pid]  = bytearray()
 
-    # Join on proesses, reading stdout as we can
+    # Join on processes, reading stdout as it becomes available
     while procs:
-        # Remove finished processes from the list
-        for p in procs:
-            if p.poll() is not None:           # process ended
-                print(p.stdout.read(), end='') # print remaining stdout
-                p.stdout.close()               # clean up file descriptors
-                procs.remove(p)                # remove the process
+        # Flush once per wakeup rather than once per line
+        out.flush()
+
+        # Processes without a pidfd that have closed stdout must be polled,
+        # so bound the wait rather than blocking on the remaining processes.
+        wait = timeout
+        if closed and (timeout is None or timeout > POLL_INTERVAL):
+            wait = POLL_INTERVAL
+
+        for key, _ in sel.select(wait):
+            event, p = key.data
+
+            if event == "exit":
+                # The process has ended, so wait will not block
+                sel.unregister(key.fileobj)
+                os.close(pidfds.pop(p.pid))
+                p.wait()
+
+                # Drain any remaining stdout along with the partial line
+                if not p.stdout.closed:
+                    tails[p.pid] += p.stdout.read()
+                    sel.unregister(p.stdout)
+                    p.stdout.close()               # clean up file descriptors
 
-        # Attempt to read stdout where we can
-        rlist = select([p.stdout for p in procs], [], [], timeout)[0]
-        for f in rlist:
-            print(f.readline(), end='')
+                pprint(out, labels[p.pid], tails.pop(p.pid))
+                del procs[p.pid]                   # remove the process
+                continue
+
+            # Exit may have been handled earlier in this batch
+            if p.stdout.closed:
+                continue
+
+            # Read whatever is available in bulk, writing out complete lines
+            # and holding on to any partial line until the rest arrives.
+            chunk = os.read(p.stdout.fileno(), READ_SIZE)
+            if chunk:
+                tail = tails[p.pid]
+                tail += chunk
+                idx  = tail.rfind(b"\n") + 1
+                if idx:
+                    pprint(out, labels[p.pid], bytes(tail[:idx]))
+                    del tail[:idx]
+                continue
+
+            # EOF on stdout; without a pidfd, the process is polled for exit
+            sel.unregister(p.stdout)
+            p.stdout.close()                       # clean up file descriptors
+            if p.pid not in pidfds:
+                pprint(out, labels[p.pid], tails.pop(p.pid))
+                closed[p.pid] = p
+
+        # Reap the polled processes that have ended
+        for pid in [pid for pid, p in closed.items() if p.poll() is not None]:
+            del closed[pid]
+            del procs[pid]                         # remove the process
+
+    out.flush()
+    sel.close()
 
 
 ##########################################################################
@@ -97,8 +246,12 @@ if __name__ == '__main__':
     # Add the arguments
     parser.add_argument('--version', action='version', version=VERSION)
     parser.add_argument(
-        '-t', '--timeout', type=float, metavar="SEC", default=0.1,
-        help='specify the select timeout for sync',
+        '-t', '--timeout', type=float, metavar="SEC", default=None,
+        help='maximum time to block waiting for output (blocks by default)',
+    )
+    parser.add_argument(
+        '-p', '--prefix', action='store_true', default=False,
+        help='prefix each line of output with the pid of its process',
     )
     parser.add_argument(
         '-d', '--debug', action='store_true', default=False,
@@ -115,7 +268,10 @@ if __name__ == '__main__':
     # Handle the input from the command line
     try:
         args = parser.parse_args()
-        execute(args.commands, debug=args.debug, timeout=args.timeout)
+        execute(
+            args.commands, debug=args.debug, timeout=args.timeout,
+            prefix=args.prefix,
+        )
         parser.exit(0)
     except Exception as e:
         parser.error(str(e))
@@ -19,12 +19,14 @@ Generates unique, long, reproducible passwords.
 ##########################################################################
 
 import os
+import hmac
 import uuid
 import yaml
 import base64
 import hashlib
 import commis
 import confire
+import functools
 
 from commis import color
 from getpass import getpass
@@ -35,7 +37,7 @@ from commis.exceptions import ConsoleError
 ## Program Constants
 ##########################################################################
 
-VERSION = "pwgen.py v1.1"
+VERSION = "pwgen.py v2.0"
 EPILOG  = "See http://bit.ly/1ROIahb for more information."
 DESCRIPTION = "Generates unique, long, reproducible passwords."
 
@@ -63,9 +65,23 @@ class Configuration(confire.Configuration):
     # Timestamp of the last configuration
     last_configured = None
 
+    # The key derivation used to hash passwords, either "scrypt" or "sha256".
+    # Configurations from before scrypt have no kdf, so they keep the legacy
+    # SHA-256 hashing (and the passwords already generated with it).
+    kdf = "sha256"
+
+    # Cost parameters of the scrypt key derivation: these can be tuned to the
+    # device but note that changing them changes every generated password.
+    kdf_n = 32768
+    kdf_r = 8
+    kdf_p = 1
+
 
 settings = Configuration.load()
 
+# Supported key derivations for the kdf setting
+KDFS = ("scrypt", "sha256")
+
 
 ##########################################################################
 ## Password Utilities
@@ -76,56 +92,115 @@ class Utilities(object):
     Mixin to provide utilities to command classes.
     """
 
-    def confirm_password(self, password, confirm):
+    def confirm_password(self, password, confirm, kdf=None):
         """
-        Compares the password to the confirmation in two ways.
+        Compares the password to the confirmation in two ways, both in
+        constant time so that the comparison does not leak timing. The
+        encoded comparison uses the configured kdf unless one is given.
         """
+        confirm = confirm.encode('utf-8')
+
         # Phase 1: Direct Comparison
-        if password == confirm:
+        if hmac.compare_digest(password.encode('utf-8'), confirm):
             return True
 
         # Phase 2: Encoded Comparison
+        device = self.get_device()
         master = self.encode_password(
-            "{}{}".format(self.get_device(), password)
+            f"{device}{password}", self.get_salt(device), kdf=kdf
         )
 
-        if master == confirm:
+        if hmac.compare_digest(master.encode('utf-8'), confirm):
             return True
 
         return False
 
-    def get_device(self):
+    @staticmethod
+    @functools.lru_cache(maxsize=1)
+    def get_device():
+        """
+        Returns the device specific UUID, computed once per process.
+        """
         return str(uuid.uuid3(uuid.NAMESPACE_OID, str(uuid.getnode())))
 
-    def get_password(self, attempts=0, confirm=settings.password_master):
-
-        password = getpass("Enter master passphrase: ").strip()
-        confirm  = confirm or getpass("Enter same passphrase again: ").strip()
+    def get_salt(self, *parts):
+        """
+        Derives a fixed length salt for the key derivation from the given
+        (non-secret) parts, e.g. the domain or the device UUID.
+        """
+        return hashlib.sha256("".join(parts).encode('utf-8')).digest()
 
-        if not self.confirm_password(password, confirm):
-            if attempts <= 3:
-                print color.format(
+    def get_password(self, attempts=4, master=True):
+        """
+        Prompts for the master password, checking it against the configured
+        master hash (unless master is False) or a second entry, retrying up
+        to the number of attempts.
+        """
+        for attempt in range(attempts):
+            password = getpass("Enter master passphrase: ").strip()
+            confirm  = (
+                (master and settings.password_master) or
+                getpass("Enter same passphrase again: ").strip()
+            )
+
+            if self.confirm_password(password, confirm):
+                break
+
+            # A stored master hashed by the other kdf will never match
+            if master and settings.password_master:
+                self.check_master_kdf(password)
+
+            if attempt + 1 < attempts:
+                print(color.format(
                     "Password doesn't match configuration or confirmation, try again.",
                     color.YELLOW
-                )
-                return self.get_password(attempts+1)
-            else:
-                raise ConsoleError(
-                    "Password attempt maximum, stretch fingers and try again!"
-                )
+                ))
+        else:
+            raise ConsoleError(
+                "Password attempt maximum, stretch fingers and try again!"
+            )
 
         if not password:
             raise ConsoleError("You must supply a base password for the generator!")
         return password
 
-    def encode_password(self, password):
+    def check_master_kdf(self, password):
+        """
+        Raises an error that explains the mismatch if the password matches the
+        stored master when it is hashed with the kdf that is not configured.
         """
-        The encoding and hashing scheme for passwords. Currently:
+        for kdf in KDFS:
+            if kdf == settings.kdf: continue
+            if self.confirm_password(password, settings.password_master, kdf=kdf):
+                raise ConsoleError(
+                    f"The configured master password was hashed with {kdf} but "
+                    f"the configured kdf is {settings.kdf}: set 'kdf: {kdf}' in "
+                    f"{settings.CONF_PATHS[0]} or run config to rehash it."
+                )
 
-            SHA-256 hashing
+    def encode_password(self, password, salt, kdf=None):
+        """
+        The encoding and hashing scheme for passwords, by the configured kdf
+        (unless one is given). Currently:
+
+            scrypt key derivation (cost parameters from the configuration)
+            or SHA-256 hashing (legacy, the salt is not used)
             Base64 encoding
         """
-        return base64.b64encode(hashlib.sha256(password).digest())
+        kdf = kdf or settings.kdf
+        if kdf == "sha256":
+            key = hashlib.sha256(password.encode('utf-8')).digest()
+            return base64.b64encode(key).decode('ascii')
+
+        if kdf != "scrypt":
+            raise ConsoleError(f"Unknown kdf '{kdf}', use one of {', '.join(KDFS)}")
+
+        n, r, p = settings.kdf_n, settings.kdf_r, settings.kdf_p
+        key = hashlib.scrypt(
+            password.encode('utf-8'), salt=salt, n=n, r=r, p=p, dklen=32,
+            maxmem=128 * r * (n + p + 2),
+        )
+        return base64.b64encode(key).decode('ascii')
 
 ##########################################################################
 ## Commands
@@ -157,19 +232,18 @@ class Generate(commis.Command, Utilities):
         Use raw input to collect information from the command line.
         """
 
-        # Create the base password string
-        password = "{}{}{}".format(
-            args.domain[0],         # the domain (makes password unique to domains)
-            args.salt,              # the salt (for inner-domain uniqueness)
-            self.get_password()     # the master password (for reproducibility)
-        )
+        # Create the base password string from the domain (makes password
+        # unique to domains), the salt (for inner-domain uniqueness) and the
+        # master password (for reproducibility).
+        password = f"{args.domain[0]}{args.salt}{self.get_password()}"
 
         # Check to ensure device specific generation
-        if args.device:
-            password += self.get_device()
+        device = self.get_device() if args.device else ""
+        password += device
 
-        # Hash and encode the base password
-        password = self.encode_password(password)
+        # Hash and encode the base password, salted by the public parts
+        salt = self.get_salt(args.domain[0], args.salt, device)
+        password = self.encode_password(password, salt)
 
         return password
 
@@ -185,7 +259,11 @@ class Configure(commis.Command, Utilities):
         ('-o', '--output'): {
             'default': settings.CONF_PATHS[0], 'metavar': 'PATH',
             'help': 'location to write the configuration to',
-        }
+        },
+        ('-k', '--kdf'): {
+            'default': 'scrypt', 'choices': KDFS,
+            'help': 'key derivation to hash passwords with (sha256 is legacy)',
+        },
     }
 
     def handle(self, args):
@@ -193,21 +271,24 @@ class Configure(commis.Command, Utilities):
             # If we're showing settings, print and exit.
             return str(settings)
 
-        # Construct the master password
-        master = "{}{}".format(
-            self.get_device(),   # Device specific salt
-            self.get_password()  # The master password
-        )
+        # Construct the master password with the device specific salt; the
+        # password is confirmed by a second entry rather than the stored
+        # master so that a new (or legacy SHA-256) master can be replaced.
+        device = self.get_device()
+        master = f"{device}{self.get_password(master=False)}"
 
         # Update settings
-        settings.password_master = self.encode_password(master)
+        settings.kdf = args.kdf
+        settings.password_master = self.encode_password(
+            master, self.get_salt(device)
+        )
         settings.last_configured = datetime.now()
 
         # Write the path to disk
         with open(args.output, 'w') as f:
             yaml.dump(dict(settings.options()), f, indent=2, default_flow_style=False)
 
-        return "Configured settings in {}".format(args.output)
+        return f"Configured settings in {args.output}"
 
 
 ##########################################################################
@@ -20,6 +20,7 @@ dealing with commented packages in the freeze file.
 ##########################################################################
 
 import os
+import re
 import pip
 import sys
 import shutil
@@ -65,7 +66,7 @@ reqargs = (
 )
 
 # Parsable operators for semantic versioning
-operators = ("==", ">=", ">", "!=", "~=", "<", "<=")
+OPRE = re.compile(r'==|>=|<=|!=|~=|>|<')
 
 
 def parse(dep):
@@ -75,15 +76,15 @@ def parse(dep):
 
     if dep.startswith("-e") or dep.startswith("--editable"):
         if dep.startswith('-e'):
-            name = line[2:].strip()
+            name = dep[2:].strip()
         else:
-            name = line[len('--editable'):].strip().lstrip('=')
+            name = dep[len('--editable'):].strip().lstrip('=')
 
         return name, dep
 
-    for operator in operators:
-        if operator in dep:
-            return dep.split(operator, 1)[0].strip(), dep
+    match = OPRE.search(dep)
+    if match:
+        return dep[:match.start()].strip(), dep
 
     return dep, dep
 
@@ -143,7 +144,7 @@ def requires(args):
 
 
     # Yield the remaining sorted list of dependencies
-    for dep in sorted(installed.values(), key=lambda x: x.lower()):
+    for dep in sorted(installed.values(), key=str.lower):
         yield dep
 
     # Yield the uninstalled dependencies
@@ -159,9 +160,8 @@ def requires(args):
 def main(*args):
 
     # Construct the argument parser
-    parser = argparse.ArgumentParser(
-        description=DESCRIPTION, epilog=EPILOG, version=VERSION
-    )
+    parser = argparse.ArgumentParser(description=DESCRIPTION, epilog=EPILOG)
+    parser.add_argument('--version', action='version', version=VERSION)
 
     # Add the arguments from the definition above
     for keys, kwargs in ARGUMENTS.items():
@@ -169,10 +169,9 @@ def main(*args):
             keys = (keys,)
         parser.add_argument(*keys, **kwargs)
 
-    # Handle the input from the command line
-    args   = parser.parse_args()
-    output = list(requires(args))
-    args.output.write("\n".join(output)+"\n")
+    # Handle the input from the command line, streaming the output
+    args = parser.parse_args()
+    args.output.writelines(line + "\n" for line in requires(args))
 
     # Exit successfully
     parser.exit(0)
@@ -22,8 +22,12 @@ import re
 import os
 import sys
 import git
+import shutil
 import argparse
-import fileinput
+import tempfile
+
+from itertools import islice, repeat
+from concurrent.futures import ProcessPoolExecutor
 
 ##########################################################################
 ## Command Description
@@ -72,11 +76,39 @@ ARGUMENTS   = {
 ## Primary Functionality
 ##########################################################################
 
-IDRE = re.compile(r'^#\s*ID:\s+([\w\.\-]+)\s+\[([a-f0-8]*)\]\s+([\w\@\.\+\-]*)\s+\$\s*$', re.I)
+# Extensions of text files whose comments (and so ID lines) start with a #
+TEXT_EXT = {
+    '.py', '.pyx', '.sh', '.bash', '.zsh', '.rb', '.pl', '.r', '.mk',
+    '.yaml', '.yml', '.toml', '.cfg', '.ini', '.conf', '.txt', '.md',
+}
+
+# Extensions of binary files that can never hold an ID string
+BINARY_EXT = {
+    '.png', '.jpg', '.jpeg', '.gif', '.bmp', '.ico', '.tif', '.tiff', '.webp',
+    '.pdf', '.zip', '.gz', '.tgz', '.bz2', '.xz', '.7z', '.tar', '.jar',
+    '.whl', '.egg', '.pyc', '.pyo', '.so', '.dylib', '.dll', '.exe', '.o',
+    '.a', '.class', '.bin', '.dat', '.db', '.sqlite', '.pickle', '.pkl',
+    '.npy', '.npz', '.h5', '.mp3', '.mp4', '.mov', '.avi', '.wav', '.ogg',
+    '.ttf', '.otf', '.woff', '.woff2', '.eot',
+}
+
+# Number of files scanned per worker task; fewer files are scanned in-process
+SCAN_CHUNKSIZE = 64
+
+# Names of (non-hidden) directories that are never walked for ID strings
+IGNORE   = {'__pycache__', 'node_modules'}
+
+# Whitespace is restricted to the line so that the (multiline) pattern can be
+# used to match single lines or to search the contents of an entire file. Names
+# and emails match any non-space bytes, so non-ASCII (UTF-8) ones still match.
+# The line ending (including a \r) is never part of the match, so a rewrite
+# keeps the file's own line endings.
+IDRE = re.compile(rb'^#[ \t]*ID:[ \t]+([^\s\[\]]+)[ \t]+\[([a-f0-8]*)\][ \t]+([^\s\[\]]*)[ \t]+\$[ \t]*(?=\r?$)', re.I | re.M)
 
 def versionize(args):
     """
-    Primary utility for performing the versionization.
+    Primary utility for performing the versionization, yields the lines of
+    output as the files requiring an ID header are found.
     """
     try:
         path = os.path.abspath(args.repo)
@@ -89,74 +121,154 @@ def versionize(args):
         raise Exception("'{}' is not a Git repository!".format(args.repo))
 
 
-    # Construct the path version tree.
+    # Construct the path version tree, mapping each path to the oldest commit
+    # that contains it (git log lists the commits adding it oldest first).
     versions = {}
-    for commit in repo.iter_commits(args.branch):
-        for blob in commit.tree.traverse():
-            versions[blob.abspath] = commit
+    for name, commit in added_paths(repo, args.branch):
+        versions.setdefault(name, commit)
+
+    # Track the files that may require modifications
+    candidates = []
+
+    # Walk the directory path; scandir entries cache the file type from the
+    # directory listing so most entries need no additional stat calls.
+    dirs = [path]
+    while dirs:
+        # Directories that cannot be read are skipped, as os.walk did
+        try:
+            entries = os.scandir(dirs.pop())
+        except OSError:
+            continue
+
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    # Ignore hidden directories (.git) and build directories
+                    if not entry.name.startswith('.') and entry.name not in IGNORE:
+                        dirs.append(entry.path)
+                    continue
+
+                if entry.path not in versions: continue
+                if not entry.is_file(): continue
+                if not maybe_versioned(entry.path): continue
+                candidates.append(entry.path)
+
+    # Scan the candidate headers, yielding the matched files (and making the
+    # modifications if the args specifies to) as results arrive.
+    found  = False
+    output = scan_heads(
+        candidates, [versions[name] for name in candidates], args.num_lines
+    )
 
-    # Track required modifications
-    output = []
+    for match in output:
+        if not match: continue
+        name, vers = match
 
-    # Walk the directory path
-    for root, dirs, files in os.walk(path):
+        if args.modify:
+            modify_inplace(name, vers)
 
-        # Ignore hidden directories (.git)
-        dirs[:] = [d for d in dirs if not d.startswith('.')]
+        found = True
+        yield "{}  {}".format(name, vers)
 
-        for name in files:
-            name = os.path.join(root, name)
-            if name not in versions: continue
-            output.append(
-                read_head(name, versions[name], maxlines=args.num_lines)
-            )
+    if not found:
+        yield "No files require an ID header."
 
-    # Remove any non-matched files.
-    output = filter(None, output)
 
-    # Make the modifications if the args specifies to
-    if args.modify:
-        for path, vers in output:
-            modify_inplace(path, vers)
+def added_paths(repo, branch):
+    """
+    Uses a single git log to yield the absolute path of every file added on
+    the branch along with the (hexsha, email) of the commit that added it,
+    oldest commits first. Renames are reported as additions of the new path.
+    """
+    log = repo.git.log(
+        '--reverse', '--no-renames', '--diff-filter=A', '--name-only', '-z',
+        '--pretty=format:%H %ae', branch, stdout_as_string=False,
+    )
 
-    # Return the output
-    return [
-        "{}  {}".format(path, vers)
-        for path, vers in output
-    ] if output else ["No files require an ID header."]
+    # Records are NUL-NUL separated: "hexsha email\npath\0path\0..."
+    for record in log.split(b"\0\0"):
+        header, _, names = record.partition(b"\n")
+        if not header: continue
 
+        commit = tuple(header.decode('utf-8').split(" ", 1))
+        for name in names.split(b"\0"):
+            if not name: continue
+            yield os.path.join(repo.working_tree_dir, os.fsdecode(name)), commit
 
-def read_head(path, commit, maxlines=None):
+
+def maybe_versioned(path):
+    """
+    Cheaply checks if a file could hold an ID string before it is scanned:
+    files with a known text extension always could and known binary files
+    never could, otherwise (e.g. a script, Makefile or any other extension)
+    the first byte of the file must start a # comment.
     """
-    Reads the first maxlines of the file (or all lines if None) and looks
-    for the version string. If it exists, it replaces it with the commit
-    and author information.
+    ext = os.path.splitext(path)[1].lower()
+    if ext in TEXT_EXT:
+        return True
+
+    if ext in BINARY_EXT:
+        return False
+
+    with open(path, 'rb') as f:
+        return f.read(1) == b'#'
+
+
+def scan_heads(paths, commits, maxlines=None):
     """
+    Yields the result of read_head for each path, using a process pool only
+    when there are enough paths to outweigh the cost of starting workers.
+    """
+    if len(paths) < SCAN_CHUNKSIZE:
+        yield from map(read_head, paths, commits, repeat(maxlines))
+        return
+
+    with ProcessPoolExecutor() as executor:
+        yield from executor.map(
+            read_head, paths, commits, repeat(maxlines),
+            chunksize=SCAN_CHUNKSIZE,
+        )
+
 
-    with open(path, 'r') as f:
-        for idx, line in enumerate(f.readlines()):
-            if maxlines and idx >= maxlines:
-                break
+def read_head(path, commit, maxlines=None):
+    """
+    Reads the first maxlines of the file (or all lines if None or 0, none if
+    negative) and looks for the version string. If it exists, it replaces it
+    with the commit and author information.
+    """
+    hexsha, email = commit
 
+    # Only read as far as the header, matching on bytes to skip decoding
+    with open(path, 'rb') as f:
+        for line in islice(f, max(maxlines, 0) if maxlines else None):
             match = IDRE.match(line)
-            if match and not match.groups()[1]:
+            if match and not match.group(2):
                 vers = "# ID: {} [{}] {} $".format(
-                    os.path.basename(path), commit.hexsha[:7], commit.author.email
+                    os.path.basename(path), hexsha[:7], email
                 )
                 return path, vers
 
 
 def modify_inplace(path, vers):
     """
-    Modifies the ID line by writing all lines except the match line.
+    Modifies the first ID line by writing the updated contents to a temporary
+    file alongside the original, then atomically replacing the original.
     """
-    matched = False
-    for line in fileinput.input(path, inplace=1):
-        if not matched and IDRE.match(line):
-            matched = True
-            sys.stdout.write(vers + "\n")
-        else:
-            sys.stdout.write(line)
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    vers = vers.encode('utf-8')
+    data = IDRE.sub(lambda match: vers, data, count=1)
+
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        shutil.copymode(path, tmp)
+        os.replace(tmp, path)
+    except Exception:
+        os.remove(tmp)
+        raise
 
 
 ##########################################################################
@@ -166,9 +278,8 @@ def modify_inplace(path, vers):
 def main(*args):
 
     # Construct the argument parser
-    parser = argparse.ArgumentParser(
-        description=DESCRIPTION, epilog=EPILOG, version=VERSION
-    )
+    parser = argparse.ArgumentParser(description=DESCRIPTION, epilog=EPILOG)
+    parser.add_argument('--version', action='version', version=VERSION)
 
     # Add the arguments from the definition above
     for keys, kwargs in ARGUMENTS.items():
@@ -176,11 +287,10 @@ def main(*args):
             keys = (keys,)
         parser.add_argument(*keys, **kwargs)
 
-    # Handle the input from the command line
+    # Handle the input from the command line, streaming the output
     # try:
-    args   = parser.parse_args()
-    output = list(versionize(args))
-    args.output.write("\n".join(output)+"\n")
+    args = parser.parse_args()
+    args.output.writelines(line + "\n" for line in versionize(args))
     # except Exception as e:
     #     parser.error(str(e))
 